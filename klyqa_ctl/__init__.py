@@ -17,4 +17,74 @@ __license__ = "MIT"
 
 from .klyqa_ctl import *
 from .general import *
-from .devices.device import format_uid
+
+"""names of the submodules the package namespace exposed through the star
+imports in klyqa_ctl.py"""
+from .devices.device import (
+    KlyqaDevice,
+    KlyqaDeviceResponse,
+    KlyqaDeviceResponseIdent,
+    device_configs,
+    format_uid,
+)
+from .devices.light import (
+    BULB_SCENES,
+    KlyqaBulb,
+    KlyqaBulbResponseStatus,
+    add_command_args_bulb,
+    brightness_message,
+    color_message,
+    commands_send_to_bulb,
+    external_source_message,
+    percent_color_message,
+    process_args_to_msg_lighting,
+    temperature_message,
+)
+from .devices.vacuum import (
+    VC_SUCTION_STRENGTHS,
+    VC_WORKINGMODE,
+    VC_WORKINGSTATUS,
+    CommandType,
+    KlyqaVC,
+    KlyqaVCResponseStatus,
+    add_command_args_cleaner,
+    process_args_to_msg_cleaner,
+)
+from .general.message import MSG_COUNTER, Message, Message_state
+from .general.general import (
+    AES_KEY_DEV,
+    DEFAULT_COM_PROC_TIMEOUT_SECS,
+    DEFAULT_MAX_CLOUD_REQUESTS,
+    DEFAULT_SEND_TIMEOUT_MS,
+    KLYQA_CTL_VERSION,
+    LOGGER,
+    PRODUCT_URLS,
+    SEND_LOOP_MAX_SLEEP_TIME,
+    AsyncIOLock,
+    Device_config,
+    DeviceType,
+    RefParse,
+    RGBColor,
+    TypeJSON,
+    aes_key_to_bytes,
+    async_json_cache,
+    formatter,
+    get_fields,
+    get_obj_attr_values_as_string,
+    get_obj_attrs_as_string,
+    json_dumps,
+    json_dumps_pretty,
+    json_loads,
+    jwt_expiry,
+    logging_hdl,
+    sep_width,
+)
+from .general.connections import (
+    PROD_HOST,
+    TEST_HOST,
+    AesCbcStream,
+    CloudConnection,
+    Data_communicator,
+    LocalConnection,
+    send_msg,
+)
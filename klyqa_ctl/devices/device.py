@@ -2,6 +2,7 @@
 from __future__ import annotations
 import asyncio
 import datetime
+import functools
 import traceback
 from typing import Any
 
@@ -12,6 +13,7 @@ from ..general.message import Message
 import slugify
 
 
+@functools.lru_cache(maxsize=4096)
 def format_uid(text: str) -> str:
     return slugify.slugify(text)
 
@@ -2,14 +2,22 @@
 
 from __future__ import annotations
 import argparse
+from enum import Enum
 import functools
 import json
 import sys
+from typing import Any
 
 from ..general.parameters import add_config_args, get_description_parser
-from .device import *
-
-from ..general.general import *
+from .device import KlyqaDevice, KlyqaDeviceResponse, device_configs, format_uid
+
+from ..general.general import (
+    LOGGER,
+    DeviceType,
+    RGBColor,
+    get_obj_attr_values_as_string,
+    sep_width,
+)
 
 ## Bulbs ##
 
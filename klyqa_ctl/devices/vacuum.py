@@ -1,11 +1,12 @@
 """Vacuum cleaner"""
 from __future__ import annotations
 import argparse
+import datetime
 from enum import Enum
 import json
 from typing import Type, Any
-from .device import *
-from ..general.general import get_obj_attr_values_as_string
+from .device import KlyqaDevice, KlyqaDeviceResponse
+from ..general.general import LOGGER, get_obj_attr_values_as_string
 
 ## Vacuum Cleaner ##
 
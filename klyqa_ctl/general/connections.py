@@ -3,32 +3,45 @@
 from __future__ import annotations
 import datetime
 import json
+import logging
+import platform
 import socket
-from typing import Any
-from ..devices.device import *
+from typing import TYPE_CHECKING, Any
 
-from .general import *
+from .general import LOGGER
+
+if TYPE_CHECKING:
+    from ..devices.device import KlyqaDevice
 
 try:
-    from Cryptodome.Cipher import AES  # provided by pycryptodome
-    from Cryptodome.Random import get_random_bytes  # pycryptodome
-except:
+    from Cryptodome.Cipher import AES  # provided by pycryptodomex
+    from Cryptodome.Random import get_random_bytes  # pycryptodomex
+    from Cryptodome.Util import _cpu_features
+except ImportError:
     from Crypto.Cipher import AES  # provided by pycryptodome
     from Crypto.Random import get_random_bytes  # pycryptodome
 
+    # Fails on the pure python pycrypto, which would make the AES slow.
+    from Crypto.Util import _cpu_features
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+if platform.machine().lower() in ("x86_64", "amd64") and not _cpu_features.have_aes_ni():
+    LOGGER.warning("AES-NI not available for pycryptodome, local AES is slower.")
+
 
 def send_msg(msg, device: KlyqaDevice, connection: LocalConnection):
-    info_str: str = (
-        'Sending in local network to "'
-        + device.get_name()
-        + '": '
-        + json.dumps(json.loads(msg), sort_keys=True, indent=4)
-    )
-
-    LOGGER.info(info_str)
+    if LOGGER.isEnabledFor(logging.INFO):
+        LOGGER.info(
+            'Sending in local network to "%s": %s',
+            device.get_name(),
+            json.dumps(json.loads(msg), sort_keys=True, indent=4),
+        )
     plain = msg.encode("utf-8")
-    while len(plain) % 16:
-        plain = plain + bytes([0x20])
+    plain += b" " * (-len(plain) % 16)
 
     if connection.sendingAES is None:
         return False
@@ -47,6 +60,22 @@ def send_msg(msg, device: KlyqaDevice, connection: LocalConnection):
     return False
 
 
+class AesCbcStream:
+    """AES CBC stream of one direction of a local connection. Uses OpenSSL via
+    cryptography if installed, else pycryptodome. The CBC chain continues over
+    all messages of the connection."""
+
+    def __init__(self, key: bytes, iv: bytes, encrypt: bool) -> None:
+        if Cipher is not None:
+            cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
+            ctx = cipher.encryptor() if encrypt else cipher.decryptor()
+            self.encrypt = self.decrypt = ctx.update
+        else:
+            aes = AES.new(key, AES.MODE_CBC, iv=iv)
+            self.encrypt = aes.encrypt
+            self.decrypt = aes.decrypt
+
+
 class LocalConnection:
     """LocalConnection"""
 
@@ -54,8 +83,8 @@ class LocalConnection:
     localIv: bytes = get_random_bytes(8)
     remoteIv: bytes = b""
 
-    sendingAES = None
-    receivingAES = None
+    sendingAES: AesCbcStream | None = None
+    receivingAES: AesCbcStream | None = None
     address: dict[str, str | int] = {"ip": "", "port": -1}
     socket: socket.socket | None = None
     received_packages: list[Any] = []
@@ -75,6 +104,17 @@ class LocalConnection:
         self.aes_key_confirmed = False
         self.started: datetime.datetime = datetime.datetime.now()
 
+    def init_aes(self, aes_key: bytes) -> None:
+        """Set up the sending and receiving AES streams once for the connection
+        after the initial vectors are exchanged. They are reused for all
+        messages of the connection."""
+        self.sendingAES = AesCbcStream(
+            aes_key, self.localIv + self.remoteIv, encrypt=True
+        )
+        self.receivingAES = AesCbcStream(
+            aes_key, self.remoteIv + self.localIv, encrypt=False
+        )
+
 
 class CloudConnection:
     """CloudConnection"""
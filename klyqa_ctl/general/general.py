@@ -1,6 +1,7 @@
 """General types, constants, functions"""
 from __future__ import annotations
 import asyncio, aiofiles
+import base64
 from enum import Enum
 
 from typing import Any, Literal
@@ -10,6 +11,11 @@ import logging
 import os
 import sys
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 LOGGER: logging.Logger = logging.getLogger(__package__)
 LOGGER.setLevel(level=logging.INFO)
 formatter: logging.Formatter = logging.Formatter(
@@ -24,6 +30,7 @@ LOGGER.addHandler(logging_hdl)
 
 DEFAULT_SEND_TIMEOUT_MS = 30
 DEFAULT_COM_PROC_TIMEOUT_SECS = 600
+DEFAULT_MAX_CLOUD_REQUESTS = 32
 
 TypeJSON = dict[str, Any]
 
@@ -123,14 +130,48 @@ class RefParse:
 Device_config = dict
 
 
-async def async_json_cache(json_data, json_file) -> tuple[Device_config, bool]:
+def json_loads(s: str | bytes) -> Any:
+    """Parse json with orjson if available, else with the json module."""
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+def json_dumps(obj: Any) -> str:
+    """Dump json compact with orjson if available, else with the json module
+    in the same format."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def json_dumps_bytes(obj: Any) -> bytes:
+    """Dump json compact and utf-8 encoded, without a str round trip on
+    orjson."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json_dumps(obj).encode()
+
+
+def json_dumps_pretty(obj: Any) -> str:
+    """Dump json sorted and indented by 4 for printing. orjson only indents
+    by 2, so the printed output does not depend on the speedups extra."""
+    return json.dumps(obj, sort_keys=True, indent=4)
+
+
+async def async_json_cache(
+    json_data, json_file, optional: bool = False
+) -> tuple[Device_config, bool]:
     """
     If json data is given write it to cache json_file.
-    Else try to read from json_file the cache.
+    Else try to read from json_file the cache. A missing optional cache file is
+    only logged on debug level.
     """
 
     return_json: Device_config = json_data
     cached = False
+    path: str = os.path.dirname(sys.argv[0]) + f"/{json_file}"
+    loop = asyncio.get_running_loop()
     if json_data:
         """
         save the json for offline cache in dirpath where called script resides
@@ -138,32 +179,54 @@ async def async_json_cache(json_data, json_file) -> tuple[Device_config, bool]:
         """
         return_json = json_data
         try:
-            s = ""
-            for id, sets in json_data.items():
-                if isinstance(sets, (datetime.datetime, datetime.date)):
-                    sets = sets.isoformat()
-                s = s + '"' + id + '": ' + json.dumps(sets) + ", "
-            s = "{" + s[:-2] + "}"
-            async with aiofiles.open(
-                os.path.dirname(sys.argv[0]) + f"/{json_file}", mode="w"
-            ) as f:
-                await f.write(s)
+            data: bytes
+            if orjson is not None:
+                data = orjson.dumps(json_data)
+            else:
+                s = ""
+                for id, sets in json_data.items():
+                    if isinstance(sets, (datetime.datetime, datetime.date)):
+                        sets = sets.isoformat()
+                    s = s + '"' + id + '": ' + json.dumps(sets) + ", "
+                data = ("{" + s[:-2] + "}").encode()
+            async with aiofiles.open(path + ".tmp", mode="wb") as f:
+                await f.write(data)
+            await loop.run_in_executor(None, os.replace, path + ".tmp", path)
         except Exception as e:
             LOGGER.warning(f'Could not save cache for json file "{json_file}".')
     else:
         """no json data, take cached json from disk if available"""
         try:
-            async with aiofiles.open(
-                os.path.dirname(sys.argv[0]) + f"/{json_file}", mode="r"
-            ) as f:
-                s = await f.read()
-            return_json = json.loads(s)
+            async with aiofiles.open(path, mode="rb") as f:
+                data = await f.read()
+            return_json = json_loads(data)
             cached = True
-        except:
-            LOGGER.warning(f'No cache from json file "{json_file}" available.')
+        except (OSError, ValueError) as e:
+            if optional and isinstance(e, FileNotFoundError):
+                LOGGER.debug('No cache from json file "%s" available.', json_file)
+            else:
+                LOGGER.warning(f'No cache from json file "{json_file}" available.')
     return (return_json, cached)
 
 
+def aes_key_to_bytes(aes_key: str) -> bytes:
+    """Decode a hex AES key string to bytes."""
+    return bytes.fromhex(aes_key)
+
+
+def jwt_expiry(token: str) -> float | None:
+    """Read the expiry (exp claim, unix time) from a jwt access token."""
+    try:
+        payload: str = token.split(".")[1]
+        claims: Any = json_loads(
+            base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        )
+        exp: Any = claims.get("exp")
+    except (IndexError, ValueError, AttributeError):
+        return None
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+
 def get_fields(object):
     """get_fields"""
     if hasattr(object, "__dict__"):
@@ -1,13 +1,13 @@
 """Message"""
 
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import datetime
 from enum import Enum
 from typing import Any, Callable, Type
 
-from .general import *
+from .general import LOGGER
 
 Message_state = Enum("Message_state", "sent answered unsent")
 
@@ -21,14 +21,14 @@ class Message:
 
     started: datetime.datetime
     msg_queue: list[tuple]
-    msg_queue_sent = []  #: list[str] = dataclasses.field(default_factory=list)
     args: list[str]
     target_uid: str
+    msg_queue_sent: list[str] = field(default_factory=list)
     state: Type[Message_state] = Message_state.unsent
     finished: datetime.datetime | None = None
     answer: str = ""
     answer_utf8: str = ""
-    answer_json = {}
+    answer_json: dict[str, Any] = field(default_factory=dict)
     # callback on error event or answer
     callback: Callable[[Message, str], None] | None = None
     time_to_live_secs: int = -1
@@ -143,6 +143,13 @@ def add_config_args(parser: argparse.ArgumentParser) -> None:
         const=True,
         default=True,
     )
+    parser.add_argument(
+        "--daemon",
+        help="Keep the account logged in and read further commands line by line from stdin.",
+        action="store_const",
+        const=True,
+        default=False,
+    )
     parser.add_argument(
         "--dev",
         help="Developing mode. Use development AES key.",
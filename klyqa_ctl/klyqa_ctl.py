@@ -23,10 +23,10 @@
 ###################################################################
 
 from __future__ import annotations
-from dataclasses import dataclass
+import shlex
+import signal
 import socket
 import sys
-import json
 import datetime
 import argparse
 import select
@@ -34,35 +34,72 @@ import logging
 import time
 from typing import TypeVar, Any, Type
 
-from .general.parameters import get_description_parser
+from .general.parameters import add_config_args, get_description_parser
 
 
 NoneType: Type[None] = type(None)
-import requests, uuid, json
+import requests, uuid
+from requests.adapters import HTTPAdapter, Retry
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
-from collections import ChainMap
 from threading import Event
 from enum import Enum
 import asyncio, aiofiles
 import functools, traceback
-from asyncio.exceptions import CancelledError, TimeoutError
-from collections.abc import Callable
+from asyncio.exceptions import CancelledError
+from collections.abc import Callable, Iterable
 
 
-from .devices.device import *
-from .devices.light import *
-from .devices.vacuum import *
-from .general.message import *
-from .general.general import *
-from .general.connections import *
-
-try:
-    from Cryptodome.Cipher import AES  # provided by pycryptodome
-except:
-    from Crypto.Cipher import AES  # provided by pycryptodome
-
-from typing import TypeVar
+from .devices.device import (
+    KlyqaDevice,
+    KlyqaDeviceResponseIdent,
+    device_configs,
+    format_uid,
+)
+from .devices.light import (
+    KlyqaBulb,
+    KlyqaBulbResponseStatus,
+    add_command_args_bulb,
+    process_args_to_msg_lighting,
+)
+from .devices.vacuum import (
+    KlyqaVC,
+    add_command_args_cleaner,
+    process_args_to_msg_cleaner,
+)
+from .general.message import Message, Message_state
+from .general.general import (
+    AES_KEY_DEV,
+    AsyncIOLock,
+    DEFAULT_COM_PROC_TIMEOUT_SECS,
+    DEFAULT_MAX_CLOUD_REQUESTS,
+    DEFAULT_SEND_TIMEOUT_MS,
+    DeviceType,
+    Device_config,
+    KLYQA_CTL_VERSION,
+    LOGGER,
+    RefParse,
+    SEND_LOOP_MAX_SLEEP_TIME,
+    TypeJSON,
+    aes_key_to_bytes,
+    jwt_expiry,
+    async_json_cache,
+    get_obj_attrs_as_string,
+    json_dumps,
+    json_dumps_bytes,
+    json_dumps_pretty,
+    json_loads,
+    logging_hdl,
+    sep_width,
+)
+from .general.connections import (
+    Data_communicator,
+    LocalConnection,
+    PROD_HOST,
+    TEST_HOST,
+    send_msg,
+)
 
 tcp_udp_port_lock: AsyncIOLock = AsyncIOLock.instance()
 
@@ -78,6 +115,37 @@ ReturnTuple = TypeVar("ReturnTuple", tuple[int, str], tuple[int, dict])
 
 AES_KEYs: dict[str, bytes] = {}
 
+HEADER_DEFAULT: dict[str, str] = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+    "accept-encoding": "gzip, deflate",
+}
+""" constant part of the cloud request header """
+
+
+PRODUCT_DEVICE_CLASSES: tuple[tuple[str, type[KlyqaDevice]], ...] = (
+    (".lighting", KlyqaBulb),
+    (".cleaning", KlyqaVC),
+)
+""" device class by product id marker """
+
+
+def new_device_for_product(product_id: str) -> KlyqaDevice | None:
+    """Create the device object for the product id, None if unknown."""
+    for marker, device_cls in PRODUCT_DEVICE_CLASSES:
+        if marker in product_id:
+            return device_cls()
+    return None
+
+
+def merge_payloads(payloads: list[dict]) -> dict:
+    """Merge the message payloads, earlier ones take precedence."""
+    merged: dict = {}
+    for payload in reversed(payloads):
+        merged.update(payload)
+    return merged
+
+
 S = TypeVar("S", argparse.ArgumentParser, type(None))
 
 
@@ -126,23 +194,65 @@ class Klyqa_account:
 
     """
 
+    __slots__ = (
+        "host",
+        "_access_token",
+        "_token_persisted",
+        "_bearer_header",
+        "username",
+        "password",
+        "username_cached",
+        "devices",
+        "session",
+        "_cloud_requests_sem",
+        "_cloud_executor",
+        "acc_settings",
+        "acc_settings_cached",
+        "settings_lock",
+        "_settings_loaded_ts",
+        "_synced_sig",
+        "_device_config_requests",
+        "_devices_by_product",
+        "_device_config_etags",
+        "__send_loop_sleep",
+        "__tasks_done",
+        "__tasks_undone",
+        "__read_tcp_task",
+        "message_queue",
+        "message_queue_new",
+        "search_and_send_loop_task",
+        "search_and_send_loop_task_end_now",
+        "data_communicator",
+        "current_addr_connections",
+    )
+
     host: str
-    access_token: str
+    _access_token: str
+    _token_persisted: bool
+    _bearer_header: dict[str, str] | None
     username: str
     password: str
     username_cached: bool
 
     devices: dict[str, KlyqaDevice]
+    session: requests.Session
+    _cloud_requests_sem: asyncio.Semaphore
+    _cloud_executor: ThreadPoolExecutor
 
     acc_settings: TypeJSON | None
     acc_settings_cached: bool
 
-    __acc_settings_lock: asyncio.Lock
-    _settings_loaded_ts: datetime.datetime | None
+    settings_lock: asyncio.Lock
+    _settings_loaded_ts: float | None
+
+    _synced_sig: dict[str, tuple[str, str]]
+    _device_config_requests: dict[str, asyncio.Task]
+    _devices_by_product: dict[str, list[KlyqaDevice]]
+    _device_config_etags: dict[str, TypeJSON]
 
     __send_loop_sleep: asyncio.Task | None
-    __tasks_done: list[tuple[asyncio.Task, datetime.datetime, datetime.datetime]]
-    __tasks_undone: list[tuple[asyncio.Task, datetime.datetime]]
+    __tasks_done: list[tuple[asyncio.Task, float, float]]
+    __tasks_undone: list[tuple[asyncio.Task, float]]
     __read_tcp_task: asyncio.Task | None
     message_queue: dict[str, list[Message]]
     message_queue_new: list[tuple]
@@ -153,7 +263,7 @@ class Klyqa_account:
     # If connection is currently finishing due to sent messages and no messages left for that device and a new
     # message appears in the queue, send a new broadcast and establish a new connection.
     #
-    current_addr_connections: set[str] = set()
+    current_addr_connections: set[str]
 
     def __init__(
         self, data_communicator: Data_communicator, username="", password="", host=""
@@ -164,12 +274,35 @@ class Klyqa_account:
         self.password = password
         self.devices = {}
         self.acc_settings = {}
-        self.access_token: str = ""
+        self._bearer_header = None
+        self.access_token = ""
+        self._token_persisted = False
         self.host = PROD_HOST if not host else host
+        """keep-alive connections to the host, shared by all cloud requests"""
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=DEFAULT_MAX_CLOUD_REQUESTS,
+                max_retries=Retry(total=2, backoff_factor=0.1),
+            ),
+        )
+        """bound the concurrent cloud requests to the connection pool size"""
+        self._cloud_requests_sem = asyncio.Semaphore(DEFAULT_MAX_CLOUD_REQUESTS)
+        """own workers for the blocking session calls, so the cloud fan-out
+        is not capped by (and does not starve) the default executor"""
+        self._cloud_executor = ThreadPoolExecutor(
+            max_workers=DEFAULT_MAX_CLOUD_REQUESTS, thread_name_prefix="klyqa-cloud"
+        )
         self.username_cached = False
         self.acc_settings_cached = False
-        self.__acc_settings_lock = asyncio.Lock()
+        self.settings_lock = asyncio.Lock()
         self._settings_loaded_ts = None
+        self._synced_sig = {}
+        self._device_config_requests = {}
+        self._devices_by_product = {}
+        self._device_config_etags = {}
         self.__send_loop_sleep = None
         self.__tasks_done = []
         self.__tasks_undone = []
@@ -179,6 +312,7 @@ class Klyqa_account:
         self.__read_tcp_task = None
         self.data_communicator: Data_communicator = data_communicator
         self.search_and_send_loop_task_end_now = False
+        self.current_addr_connections = set()
 
     async def device_handle_local_tcp(
         self, device: KlyqaDevice | None, connection: LocalConnection
@@ -212,7 +346,8 @@ class Klyqa_account:
                     + "."
                 )
             except Exception as e:
-                LOGGER.debug(f"{traceback.format_exc()}")
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug("%s", traceback.format_exc())
             finally:
                 LOGGER.debug(
                     f"finished tcp device {connection.address['ip']}, return_state: {return_state}"
@@ -233,7 +368,7 @@ class Klyqa_account:
                     connection.socket.close()
                     connection.socket = None
                 self.current_addr_connections.remove(str(connection.address["ip"]))
-                LOGGER.debug(f"tcp closed for device.u_id.")
+                LOGGER.debug("tcp closed for device.u_id.")
                 # except Exception as e:
                 #     pass
 
@@ -284,7 +419,7 @@ class Klyqa_account:
         except CancelledError as e:
             LOGGER.error(f"Device tcp task cancelled.")
         except Exception as e:
-            LOGGER.debug(f"{e}")
+            LOGGER.debug("%s", e)
             pass
         return return_state
         pass
@@ -343,7 +478,8 @@ class Klyqa_account:
 
                     except Exception as exception:
                         LOGGER.debug("Broadcasting QCX-SYN Burst Exception")
-                        LOGGER.debug(f"{traceback.format_exc()}")
+                        if LOGGER.isEnabledFor(logging.DEBUG):
+                            LOGGER.debug("%s", traceback.format_exc())
                         read_broadcast_response = False
                         if not await self.data_communicator.bind_ports():
                             LOGGER.error("Error binding ports udp 2222 and tcp 3333.")
@@ -351,7 +487,7 @@ class Klyqa_account:
 
                     if not read_broadcast_response:
                         try:
-                            LOGGER.debug(f"sleep task create (broadcasts)..")
+                            LOGGER.debug("sleep task create (broadcasts)..")
                             self.__send_loop_sleep = loop.create_task(
                                 asyncio.sleep(
                                     SEND_LOOP_MAX_SLEEP_TIME
@@ -363,14 +499,14 @@ class Klyqa_account:
                                 )
                             )
 
-                            LOGGER.debug(f"sleep task wait..")
+                            LOGGER.debug("sleep task wait..")
                             done, pending = await asyncio.wait([self.__send_loop_sleep])
 
-                            LOGGER.debug(f"sleep task done..")
+                            LOGGER.debug("sleep task done..")
                         except CancelledError as e:
-                            LOGGER.debug(f"sleep cancelled1.")
+                            LOGGER.debug("sleep cancelled1.")
                         except Exception as e:
-                            LOGGER.debug(f"{e}")
+                            LOGGER.debug("%s", e)
                             pass
                         pass
 
@@ -463,10 +599,10 @@ class Klyqa_account:
                                     f"Address {connection.address['ip']} process task created."
                                 )
                                 self.__tasks_undone.append(
-                                    (new_task, datetime.datetime.now())
+                                    (new_task, time.monotonic())
                                 )  # device.u_id
                             else:
-                                LOGGER.debug(f"{addr[0]} already in connection.")
+                                LOGGER.debug("%s already in connection.", addr[0])
 
                     try:
                         to_del = []
@@ -482,7 +618,8 @@ class Klyqa_account:
                         for uid in to_del:
                             del self.message_queue[uid]
                     except Exception as e:
-                        LOGGER.debug(f"{traceback.format_exc()}")
+                        if LOGGER.isEnabledFor(logging.DEBUG):
+                            LOGGER.debug("%s", traceback.format_exc())
                         pass
 
                 try:
@@ -490,7 +627,7 @@ class Klyqa_account:
                     for task, started in self.__tasks_undone:
                         if task.done():
                             self.__tasks_done.append(
-                                (task, started, datetime.datetime.now())
+                                (task, started, time.monotonic())
                             )
                             e = task.exception()
                             if e:
@@ -498,23 +635,21 @@ class Klyqa_account:
                                     f"Exception error in {task.get_coro()}: {e}"
                                 )
                         else:
-                            if datetime.datetime.now() - started > datetime.timedelta(
-                                seconds=proc_timeout_secs
-                            ):
+                            if time.monotonic() - started > proc_timeout_secs:
                                 task.cancel()
                             tasks_undone_new.append((task, started))
                     self.__tasks_undone = tasks_undone_new
 
                 except CancelledError as e:
-                    LOGGER.debug(f"__tasks_undone check cancelled.")
+                    LOGGER.debug("__tasks_undone check cancelled.")
                 except Exception as e:
-                    LOGGER.debug(f"{e}")
+                    LOGGER.debug("%s", e)
                     pass
                 pass
 
                 if not len(self.message_queue_new) and not len(self.message_queue):
                     try:
-                        LOGGER.debug(f"sleep task create2 (searchandsendloop)..")
+                        LOGGER.debug("sleep task create2 (searchandsendloop)..")
                         self.__send_loop_sleep = loop.create_task(
                             asyncio.sleep(
                                 SEND_LOOP_MAX_SLEEP_TIME
@@ -522,25 +657,26 @@ class Klyqa_account:
                                 else 1000000000
                             )
                         )
-                        LOGGER.debug(f"sleep task wait..")
+                        LOGGER.debug("sleep task wait..")
                         done, pending = await asyncio.wait([self.__send_loop_sleep])
-                        LOGGER.debug(f"sleep task done..")
+                        LOGGER.debug("sleep task done..")
                     except CancelledError as e:
-                        LOGGER.debug(f"sleep cancelled2.")
+                        LOGGER.debug("sleep cancelled2.")
                     except Exception as e:
-                        LOGGER.debug(f"{e}")
+                        LOGGER.debug("%s", e)
                         pass
                 pass
 
         except CancelledError as e:
-            LOGGER.debug(f"search and send to device loop cancelled.")
+            LOGGER.debug("search and send to device loop cancelled.")
             self.message_queue = {}
-            self.message_queue_now = {}
+            self.message_queue_new = []
             for task, started in self.__tasks_undone:
                 task.cancel()
         except Exception as e:
             LOGGER.debug("Exception on send and search loop. Stop loop.")
-            LOGGER.debug(f"{traceback.format_exc()}")
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("%s", traceback.format_exc())
             return False
         return True
 
@@ -557,14 +693,13 @@ class Klyqa_account:
                 await asyncio.wait_for(self.search_and_send_loop_task, timeout=0.1)
                 LOGGER.debug("wait end for send and search loop.")
             except Exception as e:
-                LOGGER.debug(f"{traceback.format_exc()}")
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug("%s", traceback.format_exc())
             LOGGER.debug("wait end for send and search loop.")
         pass
 
     def search_and_send_loop_task_alive(self) -> None:
 
-        loop = asyncio.get_event_loop()
-
         if not self.search_and_send_loop_task or self.search_and_send_loop_task.done():
             LOGGER.debug("search and send loop task created.")
             self.search_and_send_loop_task = asyncio.create_task(
@@ -583,10 +718,9 @@ class Klyqa_account:
         args,
         callback=None,
         time_to_live_secs: int = -1,
-        started=datetime.datetime.now(),
+        started: datetime.datetime | None = None,
     ) -> bool:
 
-        loop = asyncio.get_event_loop()
         # self.message_queue_new.append((send_msg, target_device_uid, args, callback, time_to_live_secs, started))
 
         if not send_msg:
@@ -625,33 +759,65 @@ class Klyqa_account:
         self.username_cached = cached
 
         if cached:
-            LOGGER.info(f"No username or no password given using cache.")
-            if not acc_settings_cache or (
-                self.username and list(acc_settings_cache.keys())[0] != self.username
+            LOGGER.info("No username or no password given using cache.")
+            cached_username: str | None = (
+                next(iter(acc_settings_cache), None) if acc_settings_cache else None
+            )
+            if not cached_username or (
+                self.username and cached_username != self.username
             ):
                 e = f"Account settings are from another account than {self.username}."
                 LOGGER.error(e)
                 raise ValueError(e)
             else:
-                try:
-                    self.username = list(acc_settings_cache.keys())[0]
-                    self.password = acc_settings_cache[self.username]["password"]
-                    e = f"Using cache account settings from account {self.username}."
-                    LOGGER.info(e)
-                except:
+                cached_settings = acc_settings_cache[cached_username]
+                password: str | None = (
+                    cached_settings.get("password")
+                    if isinstance(cached_settings, dict)
+                    else None
+                )
+                if not password:
                     e = f"Could not load cached account settings."
                     LOGGER.error(e)
                     raise ValueError(e)
+                self.username = cached_username
+                self.password = password
+                e = f"Using cache account settings from account {self.username}."
+                LOGGER.info(e)
         else:
             e = f"Could not load cached account settings."
             LOGGER.error(e)
             raise ValueError(e)
 
-    async def login(self, print_onboarded_devices=False) -> bool:
+    async def load_token_cache(self) -> bool:
+        """Take the access token of a former login from the cache, if it is valid
+        for at least another minute and the account settings can be requested
+        with it."""
+        token_cache, cached = await async_json_cache(
+            None, f"{self.username}.token.cache.json", optional=True
+        )
+        if not cached or not isinstance(token_cache, dict):
+            return False
+        token: str | None = token_cache.get("token")
+        exp: float | None = token_cache.get("exp")
+        if not token or not exp or exp <= time.time() + 60:
+            return False
+        self.access_token = token
+        acc_settings: TypeJSON | None = await self.request("settings", timeout=30)
+        if not acc_settings:
+            self.access_token = ""
+            return False
+        LOGGER.debug("Using cached access token of account %s.", self.username)
+        self.acc_settings = acc_settings
+        self._token_persisted = True
+        return True
+
+    async def login(
+        self, print_onboarded_devices=False, request_device_states=True
+    ) -> bool:
         """Login on klyqa account, get account settings, get onboarded device profiles,
-        print all devices if parameter set."""
-        global device_configs
-        loop = asyncio.get_event_loop()
+        print all devices if parameter set. The cloud states of the devices are
+        only requested if request_device_states is set."""
 
         acc_settings_cache = {}
         if not self.username or not self.password:
@@ -660,50 +826,49 @@ class Klyqa_account:
                     os.path.dirname(sys.argv[0]) + f"/last_username", mode="r"
                 ) as f:
                     self.username = str(await f.readline()).strip()
-            except:
+            except OSError:
                 return False
 
         if self.username is not None and self.password is not None:
             login_response: requests.Response | None = None
             try:
-                login_data = {"email": self.username, "password": self.password}
+                """reuse the access token of a former login while it is valid"""
+                if not await self.load_token_cache():
+                    login_data = {"email": self.username, "password": self.password}
 
-                login_response = await loop.run_in_executor(
-                    None,
-                    functools.partial(
-                        requests.post,
+                    login_response = await self._session_request(
+                        self.session.post,
                         self.host + "/auth/login",
-                        json=login_data,
+                        headers=self.get_header_default(),
+                        data=json_dumps_bytes(login_data),
                         timeout=10,
-                    ),
-                )
-
-                if not login_response or (
-                    login_response.status_code != 200
-                    and login_response.status_code != 201
-                ):
-                    LOGGER.error(
-                        str(login_response.status_code)
-                        + ", "
-                        + str(login_response.text)
                     )
-                    raise Exception(login_response.text)
-                login_json = json.loads(login_response.text)
-                self.access_token = login_json.get("accessToken")
-                # self.acc_settings = await loop.run_in_executor(
-                #     None, functools.partial(self.request, "settings", timeout=30)
-                # )
-                self.acc_settings = await self.request("settings", timeout=30)
+
+                    if not login_response or login_response.status_code not in (
+                        200,
+                        201,
+                    ):
+                        LOGGER.error(
+                            "%s, %s", login_response.status_code, login_response.text
+                        )
+                        raise Exception(login_response.text)
+                    login_json = json_loads(login_response.content)
+                    self.access_token = login_json.get("accessToken")
+                    # self.acc_settings = await loop.run_in_executor(
+                    #     None, functools.partial(self.request, "settings", timeout=30)
+                    # )
+                    self.acc_settings = await self.request("settings", timeout=30)
 
             except Exception as e:
                 LOGGER.error(
-                    f"Error during login. Try reading account settings for account {self.username} from cache."
+                    "Error during login. Try reading account settings for account %s from cache.",
+                    self.username,
                 )
                 try:
                     acc_settings_cache, cached = await async_json_cache(
                         None, f"{self.username}.acc_settings.cache.json"
                     )
-                except:
+                except (OSError, ValueError):
                     return False
                 if not cached:
                     return False
@@ -713,27 +878,40 @@ class Klyqa_account:
             if not self.acc_settings:
                 return False
 
-            try:
-                acc_settings_cache = {
-                    **self.acc_settings,
-                    **{
-                        "time_cached": datetime.datetime.now(),
-                        "password": self.password,
-                    },
-                }
-
-                """save current account settings in cache"""
-                await async_json_cache(
-                    acc_settings_cache, f"{self.username}.acc_settings.cache.json"
-                )
+            acc_settings_cache = {
+                **self.acc_settings,
+                "time_cached": datetime.datetime.now(),
+                "password": self.password,
+            }
 
-                async with aiofiles.open(
-                    os.path.dirname(sys.argv[0]) + f"/last_username", mode="w"
-                ) as f:
-                    await f.write(self.username)
+            async def write_cache() -> None:
+                try:
+                    """save current account settings in cache"""
+                    await async_json_cache(
+                        acc_settings_cache, f"{self.username}.acc_settings.cache.json"
+                    )
 
-            except Exception as e:
-                pass
+                    async with aiofiles.open(
+                        os.path.dirname(sys.argv[0]) + f"/last_username", mode="w"
+                    ) as f:
+                        await f.write(self.username)
+
+                    """save a freshly obtained access token for the next logins,
+                    an offline login must not clobber the persisted one"""
+                    if login_response is not None and self.access_token:
+                        exp: float | None = jwt_expiry(self.access_token)
+                        if exp is not None:
+                            await async_json_cache(
+                                {"token": self.access_token, "exp": exp},
+                                f"{self.username}.token.cache.json",
+                            )
+                            self._token_persisted = True
+
+                except Exception as e:
+                    pass
+
+            """write the cache while the device states and configs are requested"""
+            cache_write_task: asyncio.Task = asyncio.create_task(write_cache())
 
             try:
                 klyqa_acc_string = (
@@ -746,188 +924,307 @@ class Klyqa_account:
                     print(klyqa_acc_string)
                     print(sep_width * "-")
 
-                queue_printer: EventQueuePrinter = EventQueuePrinter()
+                """start the printer thread only if there is something to print"""
+                queue_printer: EventQueuePrinter | None = (
+                    EventQueuePrinter() if print_onboarded_devices else None
+                )
 
-                def device_request_and_print(device_sets):
-                    state_str = (
-                        f'Name: "{device_sets["name"]}"'
-                        + f'\tAES-KEY: {device_sets["aesKey"]}'
-                        + f'\tUnit-ID: {device_sets["localDeviceId"]}'
-                        + f'\tCloud-ID: {device_sets["cloudDeviceId"]}'
-                        + f'\tType: {device_sets["productId"]}'
-                    )
+                async def device_request_and_print(device_sets, uid: str):
                     cloud_state = None
+                    local_device_id: str = device_sets["localDeviceId"]
+                    cloud_device_id: str = device_sets["cloudDeviceId"]
+                    product_id: str = device_sets["productId"]
 
-                    device: KlyqaDevice
-                    if device_sets["productId"].find(".lighting") > -1:
-                        device = KlyqaBulb()
-                    elif device_sets["productId"].find(".cleaning") > -1:
-                        device = KlyqaVC()
-                    else:
+                    device: KlyqaDevice | None = new_device_for_product(product_id)
+                    if device is None:
                         return
-                    device.u_id = format_uid(device_sets["localDeviceId"])
+                    device.u_id = uid
                     device.acc_sets = device_sets
 
-                    self.devices[format_uid(device_sets["localDeviceId"])] = device
+                    self.devices[uid] = device
+
+                    if request_device_states:
+                        async def req():
+                            try:
+                                return await self.request_cloud_device_state(
+                                    cloud_device_id
+                                )
+                            except Exception as e:
+                                return None
 
-                    async def req():
                         try:
-                            ret = await self.request(
-                                f'device/{device_sets["cloudDeviceId"]}/state',
-                                timeout=30,
-                            )
-                            return ret
-                        except Exception as e:
-                            return None
+                            cloud_state = await req()
+                            if cloud_state:
+                                device.cloud.connected = cloud_state["connected"]
 
-                    try:
-                        cloud_state = asyncio.run(req())
-                        if cloud_state:
-                            if "connected" in cloud_state:
-                                state_str = (
-                                    state_str
-                                    + f'\tCloud-Connected: {cloud_state["connected"]}'
+                                device.save_device_message(
+                                    {**cloud_state, "type": "status"}
                                 )
-                            device.cloud.connected = cloud_state["connected"]
-
-                            device.save_device_message(
-                                {**cloud_state, **{"type": "status"}}
+                            else:
+                                raise
+                        except:
+                            # if args.cloud:
+                            #     LOGGER.error(err)
+                            # else:
+                            LOGGER.info(
+                                "No answer for cloud device state request %s",
+                                local_device_id,
                             )
-                        else:
-                            raise
-                    except:
-                        err = f'No answer for cloud device state request {device_sets["localDeviceId"]}'
-                        # if args.cloud:
-                        #     LOGGER.error(err)
-                        # else:
-                        LOGGER.info(err)
 
-                    if print_onboarded_devices:
+                    if queue_printer is not None:
+                        state_str = (
+                            f'Name: "{device_sets["name"]}"'
+                            f'\tAES-KEY: {device_sets["aesKey"]}'
+                            f"\tUnit-ID: {local_device_id}"
+                            f"\tCloud-ID: {cloud_device_id}"
+                            f"\tType: {product_id}"
+                        )
+                        if cloud_state and "connected" in cloud_state:
+                            state_str = (
+                                state_str
+                                + f'\tCloud-Connected: {cloud_state["connected"]}'
+                            )
                         queue_printer.print(state_str)
 
-                device_state_req_threads = []
+                device_state_reqs = []
 
                 product_ids: set[str] = set()
-                if self.acc_settings and "devices" in self.acc_settings:
-                    for device_sets in self.acc_settings["devices"]:
+                acc_settings: TypeJSON | None = self.acc_settings
+                if acc_settings and "devices" in acc_settings:
+                    aes_keys: dict[str, bytes] = AES_KEYs
+                    for device_sets in acc_settings["devices"]:
                         # if not device_sets["productId"].startswith("@klyqa.lighting"):
                         #     continue
-                        device_state_req_threads.append(
-                            Thread(target=device_request_and_print, args=(device_sets,))
+                        """single pass: uid, aes key and product id per device"""
+                        uid: str = format_uid(device_sets["localDeviceId"])
+                        aes_key: str = device_sets["aesKey"]
+                        product_id: str = device_sets.get("productId", "")
+                        device_state_reqs.append(
+                            device_request_and_print(device_sets, uid)
                         )
-                        t = Thread(target=device_request_and_print, args=(device_sets,))
-                        # t.start()
-                        # t.join()
 
-                        if isinstance(AES_KEYs, dict):
-                            AES_KEYs[
-                                format_uid(device_sets["localDeviceId"])
-                            ] = bytes.fromhex(device_sets["aesKey"])
-                        product_ids.add(device_sets["productId"])
-
-                for t in device_state_req_threads:
-                    t.start()
-                for t in device_state_req_threads:
-                    t.join()
+                        sig: tuple[str, str] = (aes_key, product_id)
+                        if self._synced_sig.get(uid) != sig:
+                            aes_keys[uid] = aes_key_to_bytes(aes_key)
+                            self._synced_sig[uid] = sig
+                        if product_id:
+                            product_ids.add(product_id)
+
+                """product configs cache, {product id: {"etag", "config"}}"""
+                configs_cache: dict[str, Any] = {}
+                cache, cached = await async_json_cache(
+                    None, "device.configs.json", optional=True
+                )
+                if cached and isinstance(cache, dict):
+                    configs_cache = cache
+                if not self._device_config_etags:
+                    self._device_config_etags = {
+                        product_id: entry
+                        for product_id, entry in configs_cache.items()
+                        if isinstance(entry, dict)
+                        and entry.keys() == {"etag", "config"}
+                        and entry["etag"]
+                    }
 
-                queue_printer.stop()
+                async def device_configs_request() -> None:
+                    await self.request_device_configs(product_ids, device_configs)
 
-                def get_conf(id, device_configs):
-                    async def req():
-                        try:
-                            ret = await self.request("config/product/" + id, timeout=30)
-                            return ret
-                        except:
-                            return None
+                """the product configs only need the account settings, so request
+                them together with the device states"""
+                if self.acc_settings and product_ids:
+                    device_state_reqs.append(device_configs_request())
 
-                    config = asyncio.run(req())
-                    if config:
-                        device_config: Device_config = config
-                        device_configs[id] = device_config
+                await asyncio.gather(*device_state_reqs, return_exceptions=True)
 
-                if self.acc_settings and product_ids:
-                    threads: list[Thread] = [
-                        Thread(target=get_conf, args=(i, device_configs))
-                        for i in product_ids
-                    ]
-                    for t in threads:
-                        LOGGER.debug(
-                            "Try to request device config for "
-                            + t._args[0]
-                            + " from server."
-                        )
-                        t.start()
-                    for t in threads:
-                        t.join()
+                if queue_printer is not None:
+                    queue_printer.stop()
 
-                device_configs, cached = await async_json_cache(
-                    device_configs, "device.configs.json"
-                )
-                if cached:
+                """fill the product configs the server did not answer from the
+                disk cache, per product id"""
+                missing: set[str] = product_ids - device_configs.keys()
+                if configs_cache and (missing or not device_configs):
+                    for product_id in (
+                        missing & configs_cache.keys()
+                        if product_ids
+                        else configs_cache.keys()
+                    ):
+                        config: Any = configs_cache[product_id]
+                        if not isinstance(config, dict):
+                            continue
+                        if config.keys() == {"etag", "config"}:
+                            config = config["config"]
+                        device_configs[product_id] = config
                     LOGGER.info("No server reply for device configs. Using cache.")
 
+                """store the etag next to each config, write only on changes"""
+                configs_entries: dict[str, Any] = dict(configs_cache)
+                for product_id, config in device_configs.items():
+                    etag: str | None = self._device_config_etags.get(
+                        product_id, {}
+                    ).get("etag")
+                    configs_entries[product_id] = {"etag": etag, "config": config}
+                if configs_entries and configs_entries != configs_cache:
+                    await async_json_cache(configs_entries, "device.configs.json")
+
             except Exception as e:
                 LOGGER.error("Error during login to klyqa: " + str(e))
                 return False
+            finally:
+                await cache_write_task
         return True
 
+    async def request_cloud_device_state(self, cloud_device_id: str) -> TypeJSON | None:
+        """Request the cloud state of a device."""
+        return await self.request(f"device/{cloud_device_id}/state", timeout=30)
+
+    def index_device_product(self, device: KlyqaDevice) -> None:
+        """Add the device to the devices by product id index once its
+        identification is known."""
+        product_id: str = device.ident.product_id if device.ident else ""
+        if product_id:
+            devices: list[KlyqaDevice] = self._devices_by_product.setdefault(
+                product_id, []
+            )
+            if device not in devices:
+                devices.append(device)
+
+    async def request_device_configs(
+        self,
+        product_ids: Iterable[str],
+        device_configs: dict[str, Device_config],
+    ) -> None:
+        """Request the device configs of the product ids missing in device_configs
+        concurrently from the server and add them to device_configs."""
+        missing: list[str] = [p for p in product_ids if p not in device_configs]
+        if not missing:
+            return
+
+        async def fetch(product_id: str) -> TypeJSON | None:
+            LOGGER.debug("Try to request device config for %s from server.", product_id)
+            return await self.request_device_config(product_id)
+
+        async def req(product_id: str) -> TypeJSON | None:
+            """Join a request for the product id already in flight or start it."""
+            task: asyncio.Task | None = self._device_config_requests.get(product_id)
+            if task is None:
+                task = asyncio.create_task(fetch(product_id))
+                self._device_config_requests[product_id] = task
+                task.add_done_callback(
+                    lambda _: self._device_config_requests.pop(product_id, None)
+                )
+            return await asyncio.shield(task)
+
+        configs = await asyncio.gather(
+            *[req(product_id) for product_id in missing], return_exceptions=True
+        )
+        for product_id, config in zip(missing, configs):
+            if isinstance(config, BaseException):
+                LOGGER.debug(
+                    "Device config request for %s failed: %s", product_id, config
+                )
+            elif config:
+                device_configs[product_id] = config
+
+    async def request_device_config(self, product_id: str) -> TypeJSON | None:
+        """Request the device config of a product id. A config known with an etag
+        is revalidated with If-None-Match and reused on 304 Not Modified."""
+        cached: TypeJSON | None = self._device_config_etags.get(product_id)
+        headers: dict[str, str] = (
+            self.get_header() if self.access_token else self.get_header_default()
+        )
+        if cached:
+            headers["If-None-Match"] = cached["etag"]
+        try:
+            response: requests.Response = await self._session_request(
+                self.session.get,
+                f"{self.host}/config/product/{product_id}",
+                headers=headers,
+                timeout=30,
+            )
+            if response.status_code == 304 and cached:
+                return cached["config"]
+            if response.status_code != 200:
+                return None
+            config: TypeJSON = json_loads(response.content)
+        except (requests.RequestException, ValueError):
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("%s", traceback.format_exc())
+            return None
+        etag: str | None = response.headers.get("ETag")
+        if etag:
+            self._device_config_etags[product_id] = {"etag": etag, "config": config}
+        else:
+            self._device_config_etags.pop(product_id, None)
+        return config
+
     def get_header_default(self) -> dict[str, str]:
-        header: dict[str, str] = {
-            "X-Request-Id": str(uuid.uuid4()),
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-            "accept-encoding": "gzip, deflate, utf-8",
-        }
-        return header
+        return {**HEADER_DEFAULT, "X-Request-Id": uuid.uuid4().hex}
+
+    @property
+    def access_token(self) -> str:
+        return self._access_token
+
+    @access_token.setter
+    def access_token(self, access_token: str) -> None:
+        self._access_token = access_token
+        self._bearer_header = None
 
     def get_header(self) -> dict[str, str]:
-        return {
-            **self.get_header_default(),
-            **{"Authorization": "Bearer " + self.access_token},
-        }
+        """Default header with the bearer authorization. The constant part is
+        built once per access token, only the request id is new per call."""
+        if self._bearer_header is None:
+            self._bearer_header = {
+                **HEADER_DEFAULT,
+                "Authorization": "Bearer " + self._access_token,
+            }
+        return {**self._bearer_header, "X-Request-Id": uuid.uuid4().hex}
+
+    async def _session_request(
+        self, method: Callable[..., requests.Response], *args, **kwargs
+    ) -> requests.Response:
+        """Run the session request method in the executor. At most
+        DEFAULT_MAX_CLOUD_REQUESTS requests run at the same time."""
+        async with self._cloud_requests_sem:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._cloud_executor, functools.partial(method, *args, **kwargs)
+            )
 
     async def request(self, url, **kwargs) -> TypeJSON | None:
-        loop = asyncio.get_event_loop()
         answer: TypeJSON | None = None
         try:
-            response = await loop.run_in_executor(
-                None,
-                functools.partial(
-                    requests.get,
-                    self.host + "/" + url,
-                    headers=self.get_header()
-                    if self.access_token
-                    else self.get_header_default(),
-                    **kwargs,
-                ),
+            response = await self._session_request(
+                self.session.get,
+                self.host + "/" + url,
+                headers=self.get_header()
+                if self.access_token
+                else self.get_header_default(),
+                **kwargs,
             )
             if response.status_code != 200:
                 # TODO: make here a right
                 raise Exception(response.text)
-            answer = json.loads(response.text)
+            answer = json_loads(response.content)
         except Exception as e:
-            LOGGER.debug(f"{traceback.format_exc()}")
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("%s", traceback.format_exc())
             answer = None
         return answer
 
     async def post(self, url, **kwargs) -> TypeJSON | None:
-        loop = asyncio.get_event_loop()
         answer: TypeJSON | None = None
         try:
-            response = await loop.run_in_executor(
-                None,
-                functools.partial(
-                    requests.post,
-                    self.host + "/" + url,
-                    headers=self.get_header(),
-                    **kwargs,
-                ),
+            response = await self._session_request(
+                self.session.post,
+                self.host + "/" + url,
+                headers=self.get_header(),
+                **kwargs,
             )
             if response.status_code != 200:
                 raise Exception(response.text)
-            answer = json.loads(response.text)
+            answer = json_loads(response.content)
         except Exception as e:
-            LOGGER.debug(f"{traceback.format_exc()}")
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("%s", traceback.format_exc())
             answer = None
         return answer
 
@@ -941,14 +1238,25 @@ class Klyqa_account:
         #         connection.connection = None
         #     except Exception as excp:
         #         pass
-        if self.access_token:
+        """a persisted access token stays valid for the next logins"""
+        if self.access_token and not self._token_persisted:
             try:
-                response = requests.post(
-                    self.host + "/auth/logout", headers=self.get_header_default()
+                response = self.session.post(
+                    self.host + "/auth/logout",
+                    headers=self.get_header_default(),
+                    timeout=10,
                 )
                 self.access_token = ""
             except Exception as excp:
                 LOGGER.warning("Couldn't logout.")
+        self._synced_sig = {}
+        self.session.close()
+        """workers are started lazily, a new executor costs nothing until the
+        account is used again"""
+        self._cloud_executor.shutdown(wait=False)
+        self._cloud_executor = ThreadPoolExecutor(
+            max_workers=DEFAULT_MAX_CLOUD_REQUESTS, thread_name_prefix="klyqa-cloud"
+        )
 
     async def aes_handshake_and_send_msgs(
         self,
@@ -985,7 +1293,6 @@ class Klyqa_account:
 
         """
 
-        global sep_width, LOGGER
         device: KlyqaDevice | None = r_device.ref
         if device is None or connection.socket is None:
             return Device_TCP_return.unknown_error
@@ -994,10 +1301,10 @@ class Klyqa_account:
         AES_KEY = ""
 
         data: bytes = b""
-        last_send: datetime.datetime = datetime.datetime.now()
+        last_send: float = time.monotonic()
         connection.socket.settimeout(0.001)
-        pause: datetime.timedelta = datetime.timedelta(milliseconds=0)
-        elapsed: datetime.timedelta = datetime.datetime.now() - last_send
+        pause: float = 0.0
+        elapsed: float = time.monotonic() - last_send
 
         loop = asyncio.get_event_loop()
 
@@ -1023,7 +1330,7 @@ class Klyqa_account:
 
             def rm_msg() -> None:
                 try:
-                    LOGGER.debug(f"{TASK_NAME} - rm_msg()")
+                    LOGGER.debug("%s - rm_msg()", TASK_NAME)
                     self.message_queue[device.u_id].remove(msg)
                     msg.state = Message_state.sent
 
@@ -1033,7 +1340,8 @@ class Klyqa_account:
                     ):
                         del self.message_queue[device.u_id]
                 except Exception as e:
-                    LOGGER.debug(f"{TASK_NAME} - {traceback.format_exc()}")
+                    if LOGGER.isEnabledFor(logging.DEBUG):
+                        LOGGER.debug("%s - %s", TASK_NAME, traceback.format_exc())
 
             return_val = Device_TCP_return.sent
 
@@ -1050,14 +1358,15 @@ class Klyqa_account:
                     # return (7, "value not valid for device config")
                     return None
 
-            pause = datetime.timedelta(milliseconds=timeout_ms)
+            pause = timeout_ms / 1000
             try:
                 if await loop.run_in_executor(None, send_msg, text, device, connection):
                     rm_msg()
-                    last_send = datetime.datetime.now()
+                    last_send = time.monotonic()
                     return msg
             except Exception as excep:
-                LOGGER.debug(f"{TASK_NAME} - {traceback.format_exc()}")
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug("%s - %s", TASK_NAME, traceback.format_exc())
                 # return (1, "error during send")
             return None
 
@@ -1067,17 +1376,18 @@ class Klyqa_account:
             try:
                 data = await loop.run_in_executor(None, connection.socket.recv, 4096)
                 if len(data) == 0:
-                    LOGGER.debug(f"{TASK_NAME} - EOF")
+                    LOGGER.debug("%s - EOF", TASK_NAME)
                     # return (3, "TCP connection ended.")
                     return Device_TCP_return.tcp_error
             except socket.timeout:
                 pass
             except Exception as excep:
-                LOGGER.debug(f"{TASK_NAME} - {traceback.format_exc()}")
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug("%s - %s", TASK_NAME, traceback.format_exc())
                 # return (1, "unknown error")
                 return Device_TCP_return.unknown_error
 
-            elapsed = datetime.datetime.now() - last_send
+            elapsed = time.monotonic() - last_send
 
             if connection.state == "CONNECTED":
                 ## check how the answer come in and how they can be connected to the messages that has been sent.
@@ -1105,11 +1415,10 @@ class Klyqa_account:
 
             while not communication_finished and (len(data)):
                 LOGGER.debug(
-                    f"{TASK_NAME} - "
-                    + "TCP server received "
-                    + str(len(data))
-                    + " bytes from "
-                    + str(connection.address)
+                    "%s - TCP server received %d bytes from %s",
+                    TASK_NAME,
+                    len(data),
+                    connection.address,
                 )
 
                 # Read out the data package as follows: package length (pkgLen), package type (pkgType) and package data (pkg)
@@ -1120,7 +1429,7 @@ class Klyqa_account:
                 pkg: bytes = data[4 : 4 + pkgLen]
                 if len(pkg) < pkgLen:
                     LOGGER.debug(
-                        f"{TASK_NAME} - Incomplete packet, waiting for more..."
+                        "%s - Incomplete packet, waiting for more...", TASK_NAME
                     )
                     break
 
@@ -1132,8 +1441,8 @@ class Klyqa_account:
                     # safe the idenfication to device object if it is a not known device,
                     # send the local initial vector for the encrypted communication to the device.
 
-                    LOGGER.debug(f"{TASK_NAME} - Plain: {pkg}")
-                    json_response: dict[str, Any] = json.loads(pkg)
+                    LOGGER.debug("%s - Plain: %s", TASK_NAME, pkg)
+                    json_response: dict[str, Any] = json_loads(pkg)
                     try:
                         ident: KlyqaDeviceResponseIdent = KlyqaDeviceResponseIdent(
                             **json_response["ident"]
@@ -1142,22 +1451,28 @@ class Klyqa_account:
                     except Exception as e:
                         return Device_TCP_return.no_uid_device
 
+                    # snapshot, the account settings can be swapped by a refresh
+                    acc_settings: TypeJSON | None = self.acc_settings
                     is_new_device = False
                     if device.u_id != "no_uid" and device.u_id not in self.devices:
                         is_new_device = True
-                        if self.acc_settings:
-                            dev: list[dict] = [
-                                device2
-                                for device2 in self.acc_settings["devices"]
-                                if format_uid(device2["localDeviceId"])
-                                == format_uid(device.u_id)
-                            ]
-                            if dev:
-                                device.acc_sets = dev[0]
-                        if ident.product_id.find(".lighting") > -1:
-                            self.devices[device.u_id] = KlyqaBulb()
-                        elif ident.product_id.find(".cleaning") > -1:
-                            self.devices[device.u_id] = KlyqaVC()
+                        if acc_settings:
+                            u_id: str = format_uid(device.u_id)
+                            dev: dict | None = next(
+                                (
+                                    device2
+                                    for device2 in acc_settings["devices"]
+                                    if format_uid(device2["localDeviceId"]) == u_id
+                                ),
+                                None,
+                            )
+                            if dev is not None:
+                                device.acc_sets = dev
+                        new_device: KlyqaDevice | None = new_device_for_product(
+                            ident.product_id
+                        )
+                        if new_device is not None:
+                            self.devices[device.u_id] = new_device
 
                     # device_b: KlyqaDevice
                     # device.ident.product_id.startswith("@klyqa.cleaning"):
@@ -1192,6 +1507,7 @@ class Klyqa_account:
 
                     connection.received_packages.append(json_response)
                     device.save_device_message(json_response)
+                    self.index_device_product(device)
 
                     if (
                         not device.u_id in self.message_queue
@@ -1203,10 +1519,10 @@ class Klyqa_account:
 
                     found = ""
                     settings_device = ""
-                    if self.acc_settings and "devices" in self.acc_settings:
+                    if acc_settings and "devices" in acc_settings:
                         settings_device = [
                             device_sets
-                            for device_sets in self.acc_settings["devices"]
+                            for device_sets in acc_settings["devices"]
                             if format_uid(device_sets["localDeviceId"])
                             == format_uid(device.u_id)
                         ]
@@ -1216,7 +1532,7 @@ class Klyqa_account:
                     else:
                         found = found + f" {json_response['ident']['unit_id']}"
 
-                    LOGGER.info(f"{TASK_NAME} - Found device {found}")
+                    LOGGER.info("%s - Found device %s", TASK_NAME, found)
                     if "all" in AES_KEYs:
                         AES_KEY = AES_KEYs["all"]
                     elif use_dev_aes or "dev" in AES_KEYs:
@@ -1246,16 +1562,7 @@ class Klyqa_account:
                         )
                         # return (6, "missing aes key")
                         return Device_TCP_return.missing_aes_key
-                    connection.sendingAES = AES.new(
-                        AES_KEY,
-                        AES.MODE_CBC,
-                        iv=connection.localIv + connection.remoteIv,
-                    )
-                    connection.receivingAES = AES.new(
-                        AES_KEY,
-                        AES.MODE_CBC,
-                        iv=connection.remoteIv + connection.localIv,
-                    )
+                    connection.init_aes(AES_KEY)
 
                     connection.state = "CONNECTED"
 
@@ -1272,12 +1579,15 @@ class Klyqa_account:
                         json_response = None
                         try:
                             plain_utf8: str = plain.decode()
-                            json_response = json.loads(plain_utf8)
+                            json_response = json_loads(plain)
                             device.save_device_message(json_response)
                             connection.sent_msg_answer = json_response
                             connection.aes_key_confirmed = True
                             LOGGER.debug(
-                                f"{TASK_NAME} - device uid {device.u_id} aes_confirmed {connection.aes_key_confirmed}"
+                                "%s - device uid %s aes_confirmed %s",
+                                TASK_NAME,
+                                device.u_id,
+                                connection.aes_key_confirmed,
                             )
                         except:
                             LOGGER.error(
@@ -1295,66 +1605,182 @@ class Klyqa_account:
                         device.recv_msg_unproc.append(msg_sent)
                         device.process_msgs()
 
-                    LOGGER.debug(
-                        f"{TASK_NAME} - Request's reply decrypted: " + str(plain)
-                    )
+                    LOGGER.debug("%s - Request's reply decrypted: %s", TASK_NAME, plain)
                     # return (0, json_response)
                     communication_finished = True
                     break
                     return return_val
                 else:
                     LOGGER.debug(
-                        f"{TASK_NAME} - No answer to process. Waiting on answer of the device ... "
+                        "%s - No answer to process. Waiting on answer of the device ... ",
+                        TASK_NAME,
                     )
         return return_val
 
     async def request_account_settings_eco(self, scan_interval: int = 60) -> bool:
-        if not await self.__acc_settings_lock.acquire():
+        def settings_fresh() -> bool:
+            return (
+                bool(self.acc_settings)
+                and self._settings_loaded_ts is not None
+                and time.monotonic() - self._settings_loaded_ts < scan_interval
+            )
+
+        """look that the settings are loaded only once in the scan interval,
+        only take the lock when a refresh is due"""
+        if settings_fresh():
             return False
-        try:
-            ret = False
-            now = datetime.datetime.now()
-            if not self._settings_loaded_ts or (
-                now - self._settings_loaded_ts
-                >= datetime.timedelta(seconds=scan_interval)
-            ):
-                """look that the settings are loaded only once in the scan interval"""
-                ret = await self.request_account_settings()
-        finally:
-            self.__acc_settings_lock.release()
+        async with self.settings_lock:
+            if settings_fresh():
+                """another caller refreshed while we waited for the lock"""
+                return False
+            ret: bool = await self.request_account_settings()
+            self._settings_loaded_ts = time.monotonic()
         return ret
 
-    async def request_account_settings(self) -> None:
-        try:
-            self.acc_settings = await self.request("settings")
-
-            """saving updated account settings to cache"""
+    async def request_account_settings(self) -> bool:
+        acc_settings: TypeJSON | None = await self.request("settings")
+        if acc_settings:
+            """swap in the new settings, readers keep iterating their snapshot"""
+            self.acc_settings = acc_settings
+            return True
+
+        """saving updated account settings to cache"""
+
+        # acc_settings_cache = (
+        #     {args.username[0]: self.acc_settings} if self.acc_settings else {}
+        # )
+
+        # self.acc_settings, cached = await async_json_cache(
+        #     acc_settings_cache, "last.acc_settings.cache.json"
+        # )
+
+        # if cached:
+        #     LOGGER.info(
+        #         f"No server reply for account settings {args.username[0]}. Using cache."
+        #     )
+        #     if (
+        #         not self.acc_settings
+        #         or list(self.acc_settings.keys())[0] != args.username[0]
+        #     ):
+        #         LOGGER.error(
+        #             f"Account settings are from another account than "
+        #             + f"{args.username[0]}."
+        #         )
+        #         return False
+        return False
 
-            # acc_settings_cache = (
-            #     {args.username[0]: self.acc_settings} if self.acc_settings else {}
-            # )
+        # self.acc_settings = self.acc_settings[list(self.acc_settings.keys())[0]]
 
-            # self.acc_settings, cached = await async_json_cache(
-            #     acc_settings_cache, "last.acc_settings.cache.json"
-            # )
+    async def _cloud_post(
+        self,
+        device: KlyqaDevice,
+        body: bytes,
+        target: str,
+        queue_printer: EventQueuePrinter,
+        response_queue: list[str],
+        debug: bool = False,
+    ) -> None:
+        """Post the serialized message body to the target (state or command) of
+        the device over the cloud and print the response."""
+        cloud_device_id = device.acc_sets["cloudDeviceId"]
+        unit_id: str = format_uid(device.acc_sets["localDeviceId"])
+        LOGGER.info(
+            "Post %s to the device '%s' (unit_id: %s) over the cloud.",
+            target,
+            cloud_device_id,
+            unit_id,
+        )
+        resp = {
+            cloud_device_id: await self.post(
+                url=f"device/{cloud_device_id}/{target}",
+                data=body,
+            )
+        }
+        resp_print: str = json_dumps_pretty(resp) if debug else json_dumps(resp)
+        device.cloud.received_packages.append(resp)
+        response_queue.append(resp_print)
+        queue_printer.print(resp_print)
 
-            # if cached:
-            #     LOGGER.info(
-            #         f"No server reply for account settings {args.username[0]}. Using cache."
-            #     )
-            #     if (
-            #         not self.acc_settings
-            #         or list(self.acc_settings.keys())[0] != args.username[0]
-            #     ):
-            #         LOGGER.error(
-            #             f"Account settings are from another account than "
-            #             + f"{args.username[0]}."
-            #         )
-            #         return False
-        except:
-            pass
+    async def _cloud_post_locked(
+        self,
+        device: KlyqaDevice,
+        body: bytes,
+        target: str,
+        queue_printer: EventQueuePrinter,
+        response_queue: list[str],
+        debug: bool = False,
+    ):
+        """Post over the cloud while holding the use lock of the device."""
+        if not await device.use_lock():
+            LOGGER.error(f"Couldn't get use lock for device {device.get_name()})")
+            return 1
+        try:
+            await self._cloud_post(
+                device, body, target, queue_printer, response_queue, debug
+            )
+        except CancelledError:
+            LOGGER.error(
+                f"Cancelled cloud send " + (device.u_id if device.u_id else "") + "."
+            )
+        finally:
+            await device.use_unlock()
 
-        # self.acc_settings = self.acc_settings[list(self.acc_settings.keys())[0]]
+    async def _process_cloud_messages(
+        self,
+        target_uids: Iterable[str],
+        state_messages: list[dict],
+        command_messages: list[dict],
+        timeout_ms: float,
+        started: float,
+        queue_printer: EventQueuePrinter,
+        response_queue: list[str],
+        debug: bool = False,
+    ) -> None:
+        """Post the merged state and command messages to the target devices over
+        the cloud and wait at most timeout_ms since started for the answers."""
+        tasks: list[tuple[asyncio.Task, KlyqaDevice]] = []
+        target_devices: list[KlyqaDevice] = [
+            self.devices[uid] for uid in target_uids if uid in self.devices
+        ]
+
+        def create_post_tasks(target: str, msg: dict):
+            """serialize the message once for all target devices"""
+            body: bytes = json_dumps_bytes(msg)
+            return [
+                (
+                    asyncio.create_task(
+                        self._cloud_post_locked(
+                            b, body, target, queue_printer, response_queue, debug
+                        )
+                    ),
+                    b,
+                )
+                for b in target_devices
+            ]
+
+        state_payload_message: dict = merge_payloads(state_messages)
+        command_payload_message: dict = merge_payloads(command_messages)
+        if state_payload_message:
+            tasks.extend(
+                create_post_tasks("state", {"payload": state_payload_message})
+            )
+        if command_payload_message:
+            tasks.extend(create_post_tasks("command", command_payload_message))
+
+        if not tasks:
+            return
+        """wait at most timeout_ms wanted minus seconds elapsed since sending"""
+        timeout: float = max(0.0, timeout_ms / 1000 - (time.monotonic() - started))
+        done, pending = await asyncio.wait([t for t, _ in tasks], timeout=timeout)
+        for t, device in tasks:
+            if t in pending:
+                LOGGER.error(f'Timeout for "{device.get_name()}"!')
+                t.cancel()
+            elif not t.cancelled() and t.exception() is not None:
+                LOGGER.debug("Cloud post failed: %s", t.exception())
+        if pending:
+            """let the cancelled posts run their cleanup before returning"""
+            await asyncio.wait(pending)
 
     async def send_to_devices(
         self,
@@ -1383,11 +1809,9 @@ class Klyqa_account:
         if not tcp:
             tcp = self.data_communicator.tcp
         try:
-            global sep_width, device_configs
-
             loop = asyncio.get_event_loop()
 
-            send_started: datetime.datetime = datetime.datetime.now()
+            send_started: float = time.monotonic()
             
             add_command_args_ch = {
                 DeviceType.lighting.name: add_command_args_bulb,
@@ -1408,7 +1832,7 @@ class Klyqa_account:
                 args.tryLocalThanCloud = False
 
             if args.aes is not None:
-                AES_KEYs["all"] = bytes.fromhex(args.aes[0])
+                AES_KEYs["all"] = aes_key_to_bytes(args.aes[0])
 
             target_device_uids = set()
 
@@ -1494,25 +1918,9 @@ class Klyqa_account:
                 print("Send to device: " + ", ".join(args.device_unitids[0].split(",")))
 
             if not args.selectDevice:
-                product_ids: set[str] = {
-                    device.ident.product_id
-                    for uid, device in self.devices.items()
-                    if device.ident and device.ident.product_id
-                }
-
-                for product_id in list(product_ids):
-                    if product_id in device_configs:
-                        continue
-                    LOGGER.debug("Try to request device config from server.")
-                    try:
-                        config = await self.request(
-                            "config/product/" + product_id,
-                            timeout=30,
-                        )
-                        device_config: Device_config = config
-                        device_configs[product_id] = device_config
-                    except:
-                        pass
+                await self.request_device_configs(
+                    self._devices_by_product.keys(), device_configs
+                )
 
             ### device specific commands ###
 
@@ -1586,10 +1994,10 @@ class Klyqa_account:
                         async def discover_answer_end(
                             answer: TypeJSON, uid: str
                         ) -> None:
-                            LOGGER.debug(f"discover ping end")
+                            LOGGER.debug("discover ping end")
                             discover_end_event.set()
 
-                        LOGGER.debug(f"discover ping start")
+                        LOGGER.debug("discover ping start")
                         # send a message to uid "all" which is fake but will get the identification message
                         # from the devices in the aes_search and send msg function and we can send then a real
                         # request message to these discovered devices.
@@ -1603,9 +2011,7 @@ class Klyqa_account:
 
                         await discover_end_event.wait()
                         if self.devices:
-                            target_device_uids = set(
-                                u_id for u_id, v in self.devices.items()
-                            )
+                            target_device_uids = set(self.devices)
                     # else:
                     msg_wait_tasks = {}
 
@@ -1615,7 +2021,7 @@ class Klyqa_account:
                         try:
                             await asyncio.sleep(timeout_ms / 1000)
                         except CancelledError as e:
-                            LOGGER.debug(f"sleep uid {uid} cancelled.")
+                            LOGGER.debug("sleep uid %s cancelled.", uid)
                         except Exception as e:
                             pass
 
@@ -1627,7 +2033,7 @@ class Klyqa_account:
 
                     async def async_answer_callback_local(msg, uid) -> None:
                         if msg and msg.msg_queue_sent:
-                            LOGGER.debug(f"{uid} msg callback.")
+                            LOGGER.debug("%s msg callback.", uid)
                         # else:
                         #     LOGGER.debug(f"{uid} {msg} msg callback.")
                         if uid in to_send_device_uids:
@@ -1650,16 +2056,16 @@ class Klyqa_account:
 
                     for i in target_device_uids:
                         try:
-                            LOGGER.debug(f"wait for send task {i}.")
+                            LOGGER.debug("wait for send task %s.", i)
                             await asyncio.wait([msg_wait_tasks[i]])
-                            LOGGER.debug(f"wait for send task {i} end.")
+                            LOGGER.debug("wait for send task %s end.", i)
                             # await asyncio.wait_for(msg_wait_tasks[i], timeout=(timeout_ms / 1000))
                         except CancelledError as e:
-                            LOGGER.debug(f"sleep wait for uid {i} cancelled.")
+                            LOGGER.debug("sleep wait for uid %s cancelled.", i)
                         except Exception as e:
                             pass
 
-                    LOGGER.debug(f"wait for all target device uids done.")
+                    LOGGER.debug("wait for all target device uids done.")
 
                     if args.selectDevice:
                         print(sep_width * "-")
@@ -1736,12 +2142,15 @@ class Klyqa_account:
 
                         if self.devices:
                             print("")
-                            device_num_s: str = input(
-                                "Choose bulb number(s) (comma seperated) a (all),[1-9]*{,[1-9]*}*: "
+                            """prompt in the executor, so the event loop keeps running"""
+                            device_num_s: str = await loop.run_in_executor(
+                                None,
+                                input,
+                                "Choose bulb number(s) (comma seperated) a (all),[1-9]*{,[1-9]*}*: ",
                             )
                             target_device_uids_lcl = set()
                             if device_num_s == "a":
-                                return set(b.u_id for b in device_items)
+                                return {b.u_id for b in device_items}
                             else:
                                 for bulb_num in device_num_s.split(","):
                                     bulb_num: int = int(bulb_num)
@@ -1773,105 +2182,18 @@ class Klyqa_account:
                 queue_printer: EventQueuePrinter = EventQueuePrinter()
                 response_queue = []
 
-                async def _cloud_post(
-                    device: KlyqaDevice, json_message, target: str
-                ) -> None:
-                    cloud_device_id = device.acc_sets["cloudDeviceId"]
-                    unit_id: str = format_uid(device.acc_sets["localDeviceId"])
-                    LOGGER.info(
-                        f"Post {target} to the device '{cloud_device_id}' (unit_id: {unit_id}) over the cloud."
-                    )
-                    resp = {
-                        cloud_device_id: await self.post(
-                            url=f"device/{cloud_device_id}/{target}",
-                            json=json_message,
-                        )
-                    }
-                    resp_print = ""
-                    name: str = device.u_id
-                    if device.acc_sets and "name" in device.acc_sets:
-                        name = device.acc_sets["name"]
-                    resp_print: str = f'Device "{name}" cloud response:'
-                    resp_print = json.dumps(resp, sort_keys=True, indent=4)
-                    device.cloud.received_packages.append(resp)
-                    response_queue.append(resp_print)
-                    queue_printer.print(resp_print)
-
-                async def cloud_post(device: KlyqaDevice, json_message, target: str):
-                    if not await device.use_lock():
-                        LOGGER.error(
-                            f"Couldn't get use lock for device {device.get_name()})"
-                        )
-                        return 1
-                    try:
-                        await _cloud_post(device, json_message, target)
-                    except CancelledError:
-                        LOGGER.error(
-                            f"Cancelled cloud send "
-                            + (device.u_id if device.u_id else "")
-                            + "."
-                        )
-                    finally:
-                        await device.use_unlock()
-
-                started: datetime.datetime = datetime.datetime.now()
+                started: float = time.monotonic()
                 # timeout_ms = 30000
 
-                async def process_cloud_messages(target_uids) -> None:
-
-                    threads = []
-                    target_devices: list[KlyqaDevice] = [
-                        b
-                        for b in self.devices.values()
-                        for t in target_uids
-                        if b.u_id == t
-                    ]
-
-                    def create_post_threads(target, msg):
-                        return [
-                            (loop.create_task(cloud_post(b, msg, target)), b)
-                            for b in target_devices
-                        ]
-
-                    state_payload_message = dict(
-                        ChainMap(*message_queue_tx_state_cloud)
-                    )
-                    # state_payload_message = json.loads(*message_queue_tx_state_cloud) if message_queue_tx_state_cloud else ""
-
-                    command_payload_message = dict(
-                        ChainMap(*message_queue_tx_command_cloud)
-                    )
-                    # command_payload_message = json.loads(*message_queue_tx_command_cloud) if message_queue_tx_command_cloud else ""
-                    if state_payload_message:
-                        threads.extend(
-                            create_post_threads(
-                                "state", {"payload": state_payload_message}
-                            )
-                        )
-                    if command_payload_message:
-                        threads.extend(
-                            create_post_threads("command", command_payload_message)
-                        )
-
-                    count = 0
-                    timeout: float = timeout_ms / 1000
-                    for t, device in threads:
-                        count: int = count + 1
-                        """wait at most timeout_ms wanted minus seconds elapsed since sending"""
-                        try:
-                            await asyncio.wait_for(
-                                t,
-                                timeout=timeout
-                                - (datetime.datetime.now() - started).seconds,
-                            )
-                        except asyncio.TimeoutError:
-                            LOGGER.error(f'Timeout for "{device.get_name()}"!')
-                            t.cancel()
-                        except:
-                            pass
-
-                await process_cloud_messages(
-                    target_device_uids if args.cloud else to_send_device_uids
+                await self._process_cloud_messages(
+                    target_device_uids if args.cloud else to_send_device_uids,
+                    message_queue_tx_state_cloud,
+                    message_queue_tx_command_cloud,
+                    timeout_ms,
+                    started,
+                    queue_printer,
+                    response_queue,
+                    debug=args.debug,
                 )
                 """if there are still target devices that the local send couldn't reach, try send the to_send_device_uids via cloud"""
 
@@ -1884,7 +2206,9 @@ class Klyqa_account:
                 scene_start_args: list[str] = [args.type, "--routine_id", "0", "--routine_start"]
 
                 orginal_args_parser = get_description_parser()
-                scene_start_args_parser: ArgumentParser = get_description_parser()
+                scene_start_args_parser: argparse.ArgumentParser = (
+                    get_description_parser()
+                )
 
                 add_config_args(parser=orginal_args_parser)
                 add_config_args(parser=scene_start_args_parser)
@@ -1904,8 +2228,7 @@ class Klyqa_account:
                     udp=udp,
                     tcp=tcp,
                     timeout_ms=timeout_ms
-                    - (datetime.datetime.now() - send_started).total_seconds()
-                    * 1000,  # 3000
+                    - (time.monotonic() - send_started) * 1000,  # 3000
                 )
 
                 if isinstance(ret, bool) and ret:
@@ -1916,7 +2239,8 @@ class Klyqa_account:
 
             return success
         except Exception as e:
-            LOGGER.debug(traceback.format_exc())
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("%s", traceback.format_exc())
 
     async def send_to_devices_wrapped(self, args_parsed, args_in, timeout_ms=5000):
         """set up broadcast port and tcp reply connection port"""
@@ -1979,9 +2303,7 @@ class Klyqa_account:
             if msg:
                 try:
                     LOGGER.info(f"Answer received from {uid}.")
-                    print(
-                        f"{json.dumps(json.loads(msg.answer), sort_keys=True, indent=4)}"
-                    )
+                    print(json_dumps_pretty(msg.answer_json))
                 except:
                     pass
             else:
@@ -2033,26 +2355,14 @@ class Klyqa_account:
         return exit_ret
 
 
-def main():
-    # global klyqa_accs
-
-    klyqa_accs: dict[str, Klyqa_account] = None
-    if not klyqa_accs:
-        klyqa_accs = dict()
-
-    loop = asyncio.get_event_loop()
+def get_args_parser(args_in: list[str]) -> argparse.ArgumentParser | None:
+    """Make the argument parser with the command arguments of the device type
+    given in args_in."""
 
     parser = get_description_parser()
 
     add_config_args(parser=parser)
 
-    # add_command_args(parser=parser)
-    args_in: list[str] = sys.argv[1:]
-
-    # add_config_args(parser=orginal_args_parser)
-    # add_config_args(parser=discover_local_args_parser2)
-    # add_command_args(parser=discover_local_args_parser2)
-
     (
         config_args_parsed,
         _,
@@ -2064,14 +2374,77 @@ def main():
         add_command_args_bulb(parser=parser)
     else:
         LOGGER.error("Unknown command type.")
-        sys.exit(1)
+        return None
+    return parser
+
 
-    # discover_local_args_parsed2 = (
-    #     discover_local_args_parser2.parse_args(
-    #         [],
-    #         namespace=original_config_args_parsed,
-    #     )
-    # )
+async def run_daemon(klyqa_acc: Klyqa_account, timeout_ms: int) -> int:
+    """Read commands line by line from stdin and send them with the logged in
+    account until stdin ends or SIGTERM is received. Returns 1 if any of the
+    commands failed, else 0."""
+
+    loop = asyncio.get_running_loop()
+    task: asyncio.Task | None = asyncio.current_task()
+    if task is not None:
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+
+    lines: asyncio.Queue[str] = asyncio.Queue()
+
+    def read_stdin() -> None:
+        """Daemon thread, a readline pending on SIGTERM does not block the exit."""
+        try:
+            for line in sys.stdin:
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            loop.call_soon_threadsafe(lines.put_nowait, "")
+        except RuntimeError:
+            """event loop already closed"""
+            pass
+
+    Thread(target=read_stdin, name="klyqa-stdin", daemon=True).start()
+
+    exit_ret = 0
+    try:
+        while line := await lines.get():
+            args_in: list[str] = shlex.split(line)
+            if not args_in:
+                continue
+            try:
+                parser = get_args_parser(args_in)
+                if parser is None:
+                    continue
+                args_parsed = parser.parse_args(args=args_in)
+            except SystemExit:
+                """argparse printed the error, wait for the next command"""
+                continue
+            if (
+                await klyqa_acc.send_to_devices_wrapped(
+                    args_parsed, args_in.copy(), timeout_ms=timeout_ms
+                )
+                > 0
+            ):
+                exit_ret = 1
+    except CancelledError:
+        LOGGER.debug("daemon stopped.")
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+    return exit_ret
+
+
+def main():
+    # global klyqa_accs
+
+    klyqa_accs: dict[str, Klyqa_account] = None
+    if not klyqa_accs:
+        klyqa_accs = dict()
+
+    loop = asyncio.get_event_loop()
+
+    # add_command_args(parser=parser)
+    args_in: list[str] = sys.argv[1:]
+
+    parser = get_args_parser(args_in)
+    if parser is None:
+        sys.exit(1)
 
     if len(args_in) < 2:
         parser.print_help()
@@ -2118,8 +2491,11 @@ def main():
 
         klyqa_acc = klyqa_accs[args_parsed.username[0]]
         if not klyqa_acc.access_token:
-            asyncio.run(
-                klyqa_acc.login(print_onboarded_devices=print_onboarded_devices)
+            loop.run_until_complete(
+                klyqa_acc.login(
+                    print_onboarded_devices=print_onboarded_devices,
+                    request_device_states=print_onboarded_devices,
+                )
             )
             LOGGER.debug("login finished")
 
@@ -2136,8 +2512,11 @@ def main():
                 host,
             )
 
-            asyncio.run(
-                klyqa_acc.login(print_onboarded_devices=print_onboarded_devices)
+            loop.run_until_complete(
+                klyqa_acc.login(
+                    print_onboarded_devices=print_onboarded_devices,
+                    request_device_states=print_onboarded_devices,
+                )
             )
             klyqa_accs[args_parsed.username[0]] = klyqa_acc
         except:
@@ -2157,6 +2536,9 @@ def main():
     ):
         exit_ret = 1
 
+    if args_parsed.daemon:
+        exit_ret |= loop.run_until_complete(run_daemon(klyqa_acc, timeout_ms))
+
     klyqa_acc.shutdown()
 
     sys.exit(exit_ret)
@@ -0,0 +1,82 @@
+import asyncio
+import sys
+import time
+
+from klyqa_ctl import klyqa_ctl
+from klyqa_ctl.general.connections import Data_communicator
+from klyqa_ctl.klyqa_ctl import Klyqa_account
+
+
+class FakeResponse:
+    status_code = 401
+    text = "unauthorized"
+    content = b"{}"
+
+
+def token_cache(monkeypatch, exp: float, acc_settings=None) -> dict:
+    """Serve a cached access token expiring at exp and optionally cached account
+    settings. Returns the cache files written by the account."""
+    written: dict = {}
+
+    async def async_json_cache(json_data, json_file, **kwargs):
+        if json_data:
+            written[json_file] = json_data
+            return (json_data, False)
+        if json_file.endswith(".token.cache.json"):
+            return ({"token": "cached-token", "exp": exp}, True)
+        if json_file.endswith(".acc_settings.cache.json") and acc_settings:
+            return (acc_settings, True)
+        return (json_data, False)
+
+    monkeypatch.setattr(klyqa_ctl, "async_json_cache", async_json_cache)
+    return written
+
+
+def test_load_token_cache_valid_token(monkeypatch):
+    token_cache(monkeypatch, time.time() + 3600)
+    tokens: list[str] = []
+
+    async def request(self, url, **kwargs):
+        tokens.append(self.access_token)
+        return {"devices": []}
+
+    monkeypatch.setattr(Klyqa_account, "request", request)
+    account = Klyqa_account(Data_communicator(), "user@example.com", "secret")
+
+    assert asyncio.run(account.load_token_cache())
+    assert tokens == ["cached-token"]
+    assert account.acc_settings == {"devices": []}
+
+
+def test_token_expiring_within_a_minute_logs_in(monkeypatch):
+    token_cache(monkeypatch, time.time() + 30)
+    urls: list[str] = []
+
+    async def session_request(self, method, url, *args, **kwargs):
+        urls.append(url)
+        return FakeResponse()
+
+    monkeypatch.setattr(Klyqa_account, "_session_request", session_request)
+    account = Klyqa_account(Data_communicator(), "user@example.com", "secret")
+
+    assert not asyncio.run(account.load_token_cache())
+    assert urls == []
+
+    assert not asyncio.run(account.login())
+    assert urls == [account.host + "/auth/login"]
+    assert account.access_token == ""
+
+
+def test_offline_login_keeps_the_persisted_token(monkeypatch, tmp_path):
+    monkeypatch.setattr(sys, "argv", [str(tmp_path / "klyqa-ctl")])
+    written: dict = token_cache(monkeypatch, time.time() + 30, {"devices": []})
+
+    async def session_request(self, method, url, *args, **kwargs):
+        return FakeResponse()
+
+    monkeypatch.setattr(Klyqa_account, "_session_request", session_request)
+    account = Klyqa_account(Data_communicator(), "user@example.com", "secret")
+
+    assert asyncio.run(account.login(request_device_states=False))
+    assert account.acc_settings == {"devices": []}
+    assert "user@example.com.token.cache.json" not in written
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import sys
+import time
+
+import pytest
+
+from klyqa_ctl import klyqa_ctl
+from klyqa_ctl.devices.device import device_configs
+from klyqa_ctl.general.connections import Data_communicator
+from klyqa_ctl.klyqa_ctl import Klyqa_account
+
+PRODUCT_ID = "@klyqa.lighting.rgb-cw-ww.e27"
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, answer=None, headers=None) -> None:
+        self.status_code = status_code
+        self.content = json.dumps(answer).encode()
+        self.text = self.content.decode()
+        self.headers = headers or {}
+
+
+@pytest.fixture(autouse=True)
+def clear_device_configs():
+    device_configs.clear()
+    yield
+    device_configs.clear()
+
+
+def account_answering(monkeypatch, answer) -> tuple[Klyqa_account, list[dict]]:
+    """Account whose cloud requests are answered by answer(url). Returns the
+    account and the headers of the requests."""
+    headers: list[dict] = []
+
+    async def session_request(self, method, url, *args, **kwargs):
+        headers.append(kwargs.get("headers", {}))
+        return answer(url)
+
+    monkeypatch.setattr(Klyqa_account, "_session_request", session_request)
+    return Klyqa_account(Data_communicator(), "user@example.com", "secret"), headers
+
+
+def test_not_modified_config_is_reused(monkeypatch):
+    account, headers = account_answering(monkeypatch, lambda url: FakeResponse(304))
+    account._device_config_etags = {
+        PRODUCT_ID: {"etag": '"v1"', "config": {"deviceTraits": []}}
+    }
+
+    assert asyncio.run(account.request_device_config(PRODUCT_ID)) == {
+        "deviceTraits": []
+    }
+    assert headers[0]["If-None-Match"] == '"v1"'
+
+
+def test_config_without_etag_drops_the_stale_etag(monkeypatch):
+    config: dict = {"deviceTraits": [{"trait": "@core/traits/brightness"}]}
+    account, headers = account_answering(
+        monkeypatch, lambda url: FakeResponse(200, config)
+    )
+    account._device_config_etags = {
+        PRODUCT_ID: {"etag": '"v1"', "config": {"deviceTraits": []}}
+    }
+
+    assert asyncio.run(account.request_device_config(PRODUCT_ID)) == config
+    assert PRODUCT_ID not in account._device_config_etags
+
+
+def test_plain_layout_cache_is_the_offline_fallback(monkeypatch, tmp_path):
+    monkeypatch.setattr(sys, "argv", [str(tmp_path / "klyqa-ctl")])
+    config: dict = {"deviceTraits": []}
+    settings: dict = {
+        "devices": [
+            {
+                "localDeviceId": "00ac629de9ad2f4409dc",
+                "cloudDeviceId": "cloud-id",
+                "productId": PRODUCT_ID,
+                "aesKey": "00" * 16,
+                "name": "lamp",
+            }
+        ]
+    }
+    written: dict = {}
+
+    async def async_json_cache(json_data, json_file, **kwargs):
+        if json_data:
+            written[json_file] = json_data
+            return (json_data, False)
+        if json_file.endswith(".token.cache.json"):
+            return ({"token": "cached-token", "exp": time.time() + 3600}, True)
+        if json_file == "device.configs.json":
+            return ({PRODUCT_ID: config}, True)
+        return (json_data, False)
+
+    monkeypatch.setattr(klyqa_ctl, "async_json_cache", async_json_cache)
+    account, _ = account_answering(
+        monkeypatch,
+        lambda url: FakeResponse(200, settings)
+        if url.endswith("/settings")
+        else FakeResponse(503),
+    )
+
+    assert asyncio.run(account.login(request_device_states=False))
+    assert device_configs[PRODUCT_ID] == config
+    assert written["device.configs.json"] == {
+        PRODUCT_ID: {"etag": None, "config": config}
+    }
@@ -0,0 +1,27 @@
+import base64
+import json
+
+from klyqa_ctl.general.general import jwt_expiry
+
+
+def make_jwt(claims: dict) -> str:
+    def part(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    return f'{part({"alg": "HS256", "typ": "JWT"})}.{part(claims)}.signature'
+
+
+def test_jwt_expiry_valid_token():
+    assert jwt_expiry(make_jwt({"sub": "user", "exp": 1700000000})) == 1700000000.0
+
+
+def test_jwt_expiry_malformed_token():
+    assert jwt_expiry("") is None
+    assert jwt_expiry("no-dots") is None
+    assert jwt_expiry("header.!!!notbase64!!!.signature") is None
+    assert jwt_expiry("header.WzFd.signature") is None
+
+
+def test_jwt_expiry_token_without_exp():
+    assert jwt_expiry(make_jwt({"sub": "user"})) is None
+    assert jwt_expiry(make_jwt({"exp": "tomorrow"})) is None
@@ -0,0 +1,11 @@
+from klyqa_ctl.klyqa_ctl import merge_payloads
+
+
+def test_merge_payloads_earlier_take_precedence():
+    assert merge_payloads(
+        [{"brightness": 10}, {"brightness": 50, "temperature": 2700}, {"color": 1}]
+    ) == {"brightness": 10, "temperature": 2700, "color": 1}
+
+
+def test_merge_payloads_empty():
+    assert merge_payloads([]) == {}